@@ -0,0 +1,70 @@
+from token_usage import UsageStore, TokenBudget, current_context
+from convergence import ConvergencePolicy
+from job_queue import JobQueue
+
+# Shared by chain_react.py, dev/backend_groq.py and the workers that import them. Import it after load_dotenv() so
+# the CHAIN_REACT_* settings are in place.
+
+
+# Define the Groq-based model
+class GroqModel:
+    def __init__(self, client, model_name="llama-3.3-70b-versatile", usage_store=None):
+        self.client = client
+        self.model_name = model_name
+        self.usage_store = usage_store
+
+    def __call__(self, prompt):
+        # A budget downgrade swaps in a smaller model for the current stage
+        model_name = current_context().get("model") or self.model_name
+        try:
+            response = self.client.chat.completions.create(
+                messages=[
+                    {"role": "system", "content": "You are a Python code expert."},
+                    {"role": "user", "content": prompt}
+                ],
+                model=model_name,
+            )
+            if self.usage_store is not None:
+                self.usage_store.record_response(model_name, response.usage)
+            return response.choices[0].message.content
+        except Exception as e:
+            return f"Error: {e}"
+
+    def stream(self, prompt, cancel=None):
+        # Yields the reply piece by piece; stops early when the `cancel` event is set
+        model_name = current_context().get("model") or self.model_name
+        response = self.client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": "You are a Python code expert."},
+                {"role": "user", "content": prompt}
+            ],
+            model=model_name,
+            stream=True,
+        )
+        text = ""
+        usage = None
+        for chunk in response:
+            if cancel is not None and cancel.is_set():
+                response.close()
+                break
+            # Groq reports usage on the final chunk under x_groq
+            usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None) or usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+                yield chunk.choices[0].delta.content
+        if self.usage_store is not None:
+            if usage is not None:
+                self.usage_store.record_response(model_name, usage)
+            else:
+                self.usage_store.record_estimate(model_name, prompt, text)
+
+
+# Token accounting and budgets (limits come from CHAIN_REACT_*_TOKEN_BUDGET, 0 = unlimited)
+usage_store = UsageStore()
+token_budget = TokenBudget.from_env()
+
+# Stage skipping when a reviewer leaves the code unchanged (see CHAIN_REACT_SKIP_WHEN_UNCHANGED)
+convergence_policy = ConvergencePolicy.from_env()
+
+# Durable queue shared with the worker processes
+job_queue = JobQueue()
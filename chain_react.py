@@ -1,12 +1,20 @@
 import os
 import json
+import uuid
 from dotenv import load_dotenv
 from swarms import Agent, AgentRearrange
 from groq import Groq
 import gradio as gr
 
-# Load environment variables
+# Load environment variables (before the helper modules below read their CHAIN_REACT_* settings)
 load_dotenv()
+
+from code_patches import HANDOFF_MODE
+from chunked_review import REVIEW_MODE
+from speculative import SPECULATIVE
+from chain_runner import run_chain, format_report
+from chain_backend import GroqModel, usage_store, token_budget, convergence_policy, job_queue
+
 api_key = os.getenv("GROQ_API_KEY")
 if not api_key:
     raise ValueError("GROQ_API_KEY environment variable is not set.")
@@ -14,26 +22,8 @@ if not api_key:
 # Initialize Groq client
 client = Groq(api_key=api_key)
 
-# Define the Groq-based model
-class GroqModel:
-    def __init__(self, client):
-        self.client = client
-
-    def __call__(self, prompt):
-        try:
-            response = self.client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": "You are a Python code expert."},
-                    {"role": "user", "content": prompt}
-                ],
-                model="llama-3.3-70b-versatile",
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"Error: {e}"
-
 # Initialize the model
-model = GroqModel(client=client)
+model = GroqModel(client=client, usage_store=usage_store)
 
 # Define agents with updated system prompts
 first_draft_agent = Agent(
@@ -108,42 +98,105 @@ code_refinement_system = AgentRearrange(
 )
 
 # Function to process user input through the agent system
-def process_prompt(prompt):
-    try:
-        # First draft
-        draft_code = first_draft_agent(prompt)
-        
-        # Compatibility review and framework suggestions
-        refined_code = compatibility_agent(draft_code)
-        
-        # Final code after QA
-        final_code = qa_agent(refined_code)
-        
-        return final_code
-    except Exception as e:
-        return f"Error: {e}"
+def refine_prompt(
+    prompt, session_id, run_id,
+    handoff_mode=HANDOFF_MODE, review_mode=REVIEW_MODE, speculative=SPECULATIVE, cancel=None,
+):
+    # First draft -> compatibility review -> QA, with budget and convergence checks between stages
+    output, report = run_chain(
+        agents, prompt, usage_store, token_budget, session_id, run_id,
+        handoff_mode=handoff_mode, convergence=convergence_policy, review_mode=review_mode,
+        speculative=speculative, cancel=cancel,
+    )
+    return f"{output}\n\n{format_report(report)}"
+
+# Worker entry point for queued chat requests (see job_worker.py)
+def run_prompt_job(payload, attempt=1, cancel=None):
+    # Every attempt gets its own run id so retries don't inherit the failed attempt's spend
+    run_id = f"{payload['run_id']}-{attempt}"
+    # A failed stage raises, so the worker retries the job
+    response = refine_prompt(
+        payload["prompt"], session_id=payload["session_id"], run_id=run_id,
+        handoff_mode=payload.get("handoff_mode", HANDOFF_MODE), review_mode=payload.get("review_mode", REVIEW_MODE),
+        speculative=payload.get("speculative", SPECULATIVE), cancel=cancel,
+    )
+    return {"response": response, "run_id": run_id}
+
+def job_status_message(job):
+    if job["status"] == "done":
+        return job["result"]["response"]
+    if job["status"] == "failed":
+        return f"Error: job {job['id']} failed after {job['attempts']} attempt(s): {job['error']}"
+    if job["status"] == "running":
+        return f"Job `{job['id']}` is running (attempt {job['attempts']} of {job['max_attempts']})..."
+    return f"Job `{job['id']}` is queued. Start workers with `python job_worker.py` if none are running."
 
 # Gradio interface
+CHAT_WAIT_SECONDS = 600  # how long a chat request follows its job before handing back the job ID
 conversation_history = []
 is_first_launch = True  # Flag to indicate first launch
 
-def chat_ui(user_input, chat_history):
+def chat_ui(user_input, chat_history, request: gr.Request = None):
     global conversation_history, is_first_launch
 
-    # Process input through agent system
-    ai_response = process_prompt(user_input)
+    # Queue the chain for a worker; the job survives browser timeouts and restarts of this process
+    session_id = request.session_hash if request is not None else "local"
+    run_id = uuid.uuid4().hex
+    job_id = job_queue.enqueue(
+        "chain_react:run_prompt_job",
+        {
+            "prompt": user_input,
+            "session_id": session_id,
+            "run_id": run_id,
+            "handoff_mode": HANDOFF_MODE,
+            "review_mode": REVIEW_MODE,
+            "speculative": SPECULATIVE,
+        },
+    )
 
     # Update conversation history
     chat_history.append(("User", user_input))
-    chat_history.append(("AI", ai_response))
-    conversation_history.append({"user": user_input, "ai": ai_response})
+    chat_history.append(("AI", f"Job `{job_id}` queued..."))
 
     # Only trigger sharing on the first launch
     share_flag = is_first_launch
     if is_first_launch:
         is_first_launch = False
 
-    return chat_history, share_flag
+    yield chat_history, share_flag, job_id
+
+    # Poll the queue and show progress until the job finishes or the wait times out
+    job = None
+    for job in job_queue.watch(job_id, timeout=CHAT_WAIT_SECONDS):
+        chat_history[-1] = ("AI", job_status_message(job))
+        yield chat_history, share_flag, job_id
+
+    if job is None or job["status"] not in ("done", "failed"):
+        # The job keeps running in the worker; its result can be fetched later by ID
+        chat_history[-1] = ("AI", f"{job_status_message(job_queue.get(job_id))} Use **Fetch Job Result** to check on it later.")
+        yield chat_history, share_flag, job_id
+        return
+
+    # Usage of the attempt that finished (failed jobs report their last attempt)
+    attempt_run_id = job["result"]["run_id"] if job["status"] == "done" else f"{run_id}-{job['attempts']}"
+    conversation_history.append({
+        "user": user_input,
+        "ai": chat_history[-1][1],
+        "job_id": job_id,
+        "usage": usage_store.totals(run_id=attempt_run_id),
+        "stages": usage_store.stage_breakdown(attempt_run_id),
+        "stage_status": usage_store.stage_events(attempt_run_id),
+    })
+
+def fetch_job(job_id, chat_history):
+    # Recover the result of a job submitted earlier, e.g. after a page reload
+    job = job_queue.get(job_id.strip()) if job_id else None
+    if job is None:
+        chat_history.append(("AI", f"Error: unknown job `{job_id}`"))
+        return chat_history
+    chat_history.append(("User", job["payload"]["prompt"]))
+    chat_history.append(("AI", job_status_message(job)))
+    return chat_history
 
 def save_conversation():
     global conversation_history
@@ -163,6 +216,9 @@ with gr.Blocks() as demo:
             max_lines=10,  # Increased max lines 
             elem_id="code-input"
         )
+    with gr.Row():
+        job_id_box = gr.Textbox(label="Job ID", placeholder="Paste a job ID to fetch its result...")
+        fetch_button = gr.Button("Fetch Job Result")
     with gr.Row():
         copy_button = gr.Button("Copy Response to Clipboard")
         save_button = gr.Button("Save Conversation to JSON")
@@ -178,7 +234,9 @@ with gr.Blocks() as demo:
     submit_button.click(
         chat_ui, 
         inputs=[user_input, chat_history], 
-        outputs=[chat_history, gr.Textbox(visible=False)]  # Corrected output here
+        outputs=[chat_history, gr.Textbox(visible=False), job_id_box],
+        # Handlers only poll the queue, so don't limit them to one at a time; workers bound the real concurrency
+        concurrency_limit=None,
     )
     
     # Copy last AI response to clipboard
@@ -189,12 +247,17 @@ with gr.Blocks() as demo:
     
     save_button.click(save_conversation, outputs=gr.Textbox(visible=False))
 
+    fetch_button.click(fetch_job, inputs=[job_id_box, chat_history], outputs=chat_history)
+
     # Trigger submit when Enter key is pressed in the input field
     user_input.submit(
         chat_ui, 
         inputs=[user_input, chat_history], 
-        outputs=[chat_history, gr.Textbox(visible=False)]  # Corrected output here
+        outputs=[chat_history, gr.Textbox(visible=False), job_id_box],
+        # Handlers only poll the queue, so don't limit them to one at a time; workers bound the real concurrency
+        concurrency_limit=None,
     )
 
+if __name__ == "__main__":
     # Launch with share flag set only on the first launch
     demo.launch(share=True if is_first_launch else False)
@@ -0,0 +1,145 @@
+from chunked_review import should_chunk, run_chunked_stage, chunk_prompts
+from code_patches import extract_code, build_patch_task, run_patch_stage, regenerate_in_full
+from convergence import ConvergencePolicy
+from speculative import run_speculative_chain
+from token_usage import TokenBudget, BudgetExceeded, usage_context, estimate_call
+
+
+class ChainCancelled(Exception):
+    pass
+
+
+class StageFailed(Exception):
+    pass
+
+
+def estimate_stage(agent, stage_input, mode="full"):
+    # What the stage sends (system prompt, any patch or chunk instructions, the input) plus a reply about as
+    # long as its input
+    code = extract_code(stage_input) if mode == "patch" else None
+    if mode == "chunked":
+        prompts = chunk_prompts(agent, stage_input)
+    elif code is not None:
+        prompts = [agent.system_prompt, build_patch_task(stage_input, code)]
+    else:
+        prompts = [agent.system_prompt, stage_input]
+    return estimate_call(prompts, stage_input)
+
+
+def run_chain(
+    agents, prompt, usage_store, token_budget, session_id, run_id,
+    handoff_mode="full", convergence=None, review_mode="whole", speculative=False, cancel=None,
+):
+    # Runs the agents in order and returns (output, report), report holding one entry per stage.
+    # Setting the `cancel` event abandons the chain before its next stage.
+    def check_cancelled():
+        if cancel is not None and cancel.is_set():
+            raise ChainCancelled("chain cancelled")
+
+    def check_output(agent, output):
+        # The model wrappers turn API failures into "Error: ..." strings; never hand one to the next stage
+        if output is None or output.startswith("Error:"):
+            raise StageFailed(f"{agent.agent_name} failed: {output or 'empty response'}")
+
+    if speculative:
+        # Overlapping stages always hand off the full output, so patch and chunked modes don't apply
+        return run_speculative_chain(
+            agents, prompt, usage_store, token_budget, session_id, run_id, convergence, check_cancelled, check_output
+        )
+
+    convergence = convergence or ConvergencePolicy()
+    output = prompt
+    report = []
+    previous_unchanged = False
+
+    def record(agent, status, **details):
+        entry = {"stage": agent.agent_name, "status": status, **details}
+        report.append(entry)
+        usage_store.record_stage(session_id, run_id, agent.agent_name, status, details.get("reason"))
+
+    for index, agent in enumerate(agents):
+        check_cancelled()
+        if convergence.should_skip(agent.agent_name, previous_unchanged):
+            record(agent, "skipped", reason="previous stage made no code changes")
+            continue
+
+        stage_input = output
+        if index > 0 and review_mode == "chunked" and should_chunk(stage_input):
+            # Large programs are split by AST and the chunks reviewed concurrently
+            mode = "chunked"
+        elif index > 0 and handoff_mode == "patch":
+            # Reviewers send a diff against the previous stage's code instead of a whole new program
+            mode = "patch"
+        else:
+            mode = "full"
+
+        status = token_budget.status(
+            usage_store, session_id=session_id, run_id=run_id, upcoming=estimate_stage(agent, stage_input, mode)
+        )
+        if status == TokenBudget.EXHAUSTED:
+            if index == 0:
+                raise BudgetExceeded("token budget exhausted before the first draft could be generated")
+            for remaining in agents[index:]:
+                record(remaining, "skipped", reason="token budget exhausted")
+            break
+        model_override = token_budget.fallback_model if status == TokenBudget.DOWNGRADE else None
+
+        handoff = "full"
+        with usage_context(session_id=session_id, run_id=run_id, stage=agent.agent_name, model=model_override):
+            if mode == "chunked":
+                output, handoff = run_chunked_stage(agent, stage_input), "chunked"
+            elif mode == "patch":
+                output, handoff = run_patch_stage(agent, stage_input)
+            else:
+                output = agent(stage_input)
+
+        details = {}
+        if handoff == "fallback":
+            # The patch did not apply: regenerate in full as a separate call with its own budget check
+            fallback_stage = f"{agent.agent_name} (patch fallback)"
+            status = token_budget.status(
+                usage_store, session_id=session_id, run_id=run_id, upcoming=estimate_stage(agent, stage_input)
+            )
+            if status == TokenBudget.EXHAUSTED:
+                output, handoff = stage_input, "fallback-skipped"
+            else:
+                fallback_model = token_budget.fallback_model if status == TokenBudget.DOWNGRADE else model_override
+                with usage_context(session_id=session_id, run_id=run_id, stage=fallback_stage, model=fallback_model):
+                    output = regenerate_in_full(agent, stage_input)
+                details["fallback_tokens"] = usage_store.totals(run_id=run_id, stage=fallback_stage)["total_tokens"]
+        check_output(agent, output)
+
+        # A stage whose fallback was skipped produced nothing of its own, so it did not converge
+        previous_unchanged = handoff != "fallback-skipped" and convergence.unchanged(stage_input, output)
+        record(agent, "executed", model=model_override, handoff=handoff, unchanged=previous_unchanged, **details)
+
+        if previous_unchanged and convergence.stop_when_unchanged:
+            for remaining in agents[index + 1:]:
+                record(remaining, "skipped", reason=f"{agent.agent_name} returned the code unchanged")
+            break
+
+    return output, report
+
+
+def format_report(report):
+    # Short footer listing executed and skipped stages plus any budget or patch fallbacks
+    executed = [entry["stage"] for entry in report if entry["status"] == "executed"]
+    lines = [f"Stages run: {', '.join(executed) or 'none'}."]
+    for entry in report:
+        if entry["status"] == "skipped":
+            lines.append(f"Skipped {entry['stage']}: {entry['reason']}.")
+        elif entry.get("model"):
+            lines.append(f"{entry['stage']} ran on {entry['model']} to stay within the token budget.")
+        if entry.get("restarted"):
+            lines.append(f"{entry['stage']} was restarted because the upstream code changed after it started.")
+        if entry.get("handoff") == "fallback":
+            lines.append(
+                f"{entry['stage']} patch did not apply; the program was regenerated in full "
+                f"({entry.get('fallback_tokens', 0)} extra tokens)."
+            )
+        elif entry.get("handoff") == "fallback-skipped":
+            lines.append(
+                f"{entry['stage']} patch did not apply and the token budget left no room to regenerate the program; "
+                "the previous code was kept."
+            )
+    return "\n".join(f"_{line}_" for line in lines)
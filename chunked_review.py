@@ -0,0 +1,252 @@
+import ast
+import contextvars
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from code_patches import extract_code, other_blocks, strip_code_blocks, render_stage_output
+
+# "whole": reviewers see the full program, "chunked": large programs are split by AST and reviewed concurrently
+REVIEW_MODE = os.getenv("CHAIN_REACT_REVIEW_MODE", "whole")
+CHUNK_MAX_LINES = int(os.getenv("CHAIN_REACT_CHUNK_MAX_LINES", "120"))
+CHUNK_WORKERS = int(os.getenv("CHAIN_REACT_CHUNK_WORKERS", "4"))
+
+CHUNK_INSTRUCTIONS = """
+You are reviewing part {part} of {total} of a larger Python module; the other parts are reviewed separately.
+The shared imports and the signatures of code defined in other parts are given for reference only: do not return them.
+Return the reviewed version of ONLY the section under review in a single ```python fenced block. Keep every top-level
+name it defines, with compatible signatures, because other parts depend on them. Put any new imports at the top of
+that block. After the block, briefly explain your changes.
+"""
+
+DEFINITIONS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+IMPORTS = (ast.Import, ast.ImportFrom)
+
+
+def _defined_names(node):
+    if isinstance(node, DEFINITIONS):
+        return {node.name}
+    if isinstance(node, ast.Assign):
+        targets = node.targets
+    elif isinstance(node, (ast.AnnAssign, ast.AugAssign)):
+        targets = [node.target]
+    else:
+        targets = []
+    return {target.id for target in targets if isinstance(target, ast.Name)}
+
+
+def _imported_names(node):
+    if not isinstance(node, IMPORTS):
+        return set()
+    return {(alias.asname or alias.name).split(".")[0] for alias in node.names if alias.name != "*"}
+
+
+def _bound_names(node):
+    return _defined_names(node) | _imported_names(node)
+
+
+def _stub(node):
+    # Signature-only copy of a definition for use as context
+    stub = copy.copy(node)
+    if isinstance(node, ast.ClassDef):
+        methods = [_stub(child) for child in node.body if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))]
+        stub.body = methods or [ast.Expr(ast.Constant(...))]
+    else:
+        stub.body = [ast.Expr(ast.Constant(...))]
+    return stub
+
+
+def _signature(node):
+    if isinstance(node, IMPORTS):
+        return ast.unparse(node)
+    if isinstance(node, DEFINITIONS):
+        return ast.unparse(_stub(node))
+    return f"{', '.join(sorted(_defined_names(node)))} = ..."
+
+
+def _segments(code):
+    # One segment per top-level statement, carrying the comments and blank lines above it
+    tree = ast.parse(code)
+    lines = code.splitlines()
+    segments = []
+    start = 0
+    for node in tree.body:
+        end = node.end_lineno
+        segments.append({"node": node, "text": "\n".join(lines[start:end]), "lines": end - start})
+        start = end
+    if segments and start < len(lines):
+        segments[-1]["text"] += "\n" + "\n".join(lines[start:])
+    return tree, segments
+
+
+def _is_preamble(index, node):
+    docstring = index == 0 and isinstance(node, ast.Expr) and isinstance(getattr(node, "value", None), ast.Constant)
+    return docstring or isinstance(node, IMPORTS)
+
+
+def split_code(code, max_lines=CHUNK_MAX_LINES):
+    # Returns (preamble, chunks): the module's leading imports plus ordered chunks of whole top-level statements.
+    # Later imports stay where they are, since statements before them may have to run first (sys.path, matplotlib.use)
+    tree, segments = _segments(code)
+    leading = 0
+    while leading < len(segments) and _is_preamble(leading, segments[leading]["node"]):
+        leading += 1
+    preamble = [segment["text"] for segment in segments[:leading]]
+    chunks = []
+    current = []
+    for segment in segments[leading:]:
+        if current and sum(part["lines"] for part in current) + segment["lines"] > max_lines:
+            chunks.append(current)
+            current = []
+        current.append(segment)
+    if current:
+        chunks.append(current)
+
+    definitions = {}
+    for node in (segment["node"] for chunk in chunks for segment in chunk):
+        if isinstance(node, DEFINITIONS + IMPORTS + (ast.Assign, ast.AnnAssign)):
+            for name in _bound_names(node):
+                definitions[name] = node
+
+    result = []
+    for chunk in chunks:
+        nodes = [segment["node"] for segment in chunk]
+        defined = set().union(*(_defined_names(node) for node in nodes))
+        imported = set().union(*(_imported_names(node) for node in nodes))
+        used = {
+            child.id for node in nodes for child in ast.walk(node)
+            if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load)
+        }
+        # Signatures (and imports) of everything this chunk references but another chunk defines
+        context = []
+        for name in sorted(used - defined - imported):
+            node = definitions.get(name)
+            if node is not None and _signature(node) not in context:
+                context.append(_signature(node))
+        result.append({
+            "code": "\n".join(segment["text"] for segment in chunk).strip("\n"),
+            "defines": defined,
+            "imports": imported,
+            "uses": used,
+            "statements": len(nodes),
+            "context": context,
+        })
+    # Names only other chunks define: a review must not redefine them, or it would shadow the real definitions
+    for chunk in result:
+        others = [other["defines"] | other["imports"] for other in result if other is not chunk]
+        chunk["external"] = set().union(*others) - chunk["defines"] - chunk["imports"]
+    return "\n".join(preamble).strip("\n"), result
+
+
+def _remove_statements(code, drop):
+    # Split code into (removed top-level statements, remaining code) by testing each node with `drop`
+    tree = ast.parse(code)
+    lines = code.splitlines()
+    removed, skip = [], set()
+    for node in tree.body:
+        if drop(node):
+            removed.append(node)
+            skip.update(range(node.lineno - 1, node.end_lineno))
+    remaining = "\n".join(line for number, line in enumerate(lines) if number not in skip)
+    return removed, remaining.strip("\n")
+
+
+def _hoist_imports(code, original):
+    # Split a reviewed chunk into (new top-level import lines, remaining code); imports the chunk already had stay put
+    kept = {ast.unparse(node) for node in ast.parse(original).body if isinstance(node, IMPORTS)}
+    imports, remaining = _remove_statements(
+        code, lambda node: isinstance(node, IMPORTS) and ast.unparse(node) not in kept
+    )
+    return [ast.unparse(node) for node in imports], remaining
+
+
+def build_chunk_task(preamble, chunk, part, total):
+    task = CHUNK_INSTRUCTIONS.format(part=part, total=total).strip()
+    if preamble:
+        task += f"\n\nShared imports:\n```python\n{preamble}\n```"
+    if chunk["context"]:
+        task += "\n\nDefined in other parts:\n```python\n" + "\n\n".join(chunk["context"]) + "\n```"
+    return f"{task}\n\nSection under review:\n```python\n{chunk['code']}\n```"
+
+
+def _chunk_prompt(agent, preamble, chunk, part, total):
+    return f"{agent.system_prompt.strip()}\n\n{build_chunk_task(preamble, chunk, part, total)}"
+
+
+def chunk_prompts(agent, stage_input, max_lines=CHUNK_MAX_LINES):
+    # The prompts run_chunked_stage would send, for budget estimates
+    preamble, chunks = split_code(extract_code(stage_input), max_lines=max_lines)
+    return [_chunk_prompt(agent, preamble, chunk, part, len(chunks)) for part, chunk in enumerate(chunks, start=1)]
+
+
+def review_chunk(agent, preamble, chunk, part, total):
+    # Call the model directly so concurrent chunks don't share the agent's conversation memory
+    response = agent.llm(_chunk_prompt(agent, preamble, chunk, part, total))
+    reviewed = extract_code(response) if response and not response.startswith("Error:") else None
+    try:
+        # Models often repeat the stubs they were given as context; drop them so they can't shadow the real code
+        _, reviewed = _remove_statements(
+            reviewed, lambda node: bool(_bound_names(node)) and _bound_names(node) <= chunk["external"]
+        )
+        imports, code = _hoist_imports(reviewed, chunk["code"])
+        body = ast.parse(code).body
+    except (SyntaxError, TypeError, ValueError):
+        return [], chunk["code"], "review unusable, kept the original code."
+    if not body:
+        return [], chunk["code"], "review returned no code, kept the original code."
+    defined = set().union(*(_bound_names(node) for node in body))
+    if defined & chunk["external"]:
+        overlap = ", ".join(sorted(defined & chunk["external"]))
+        return [], chunk["code"], f"review redefined {overlap} from another part, kept the original code."
+    required = chunk["defines"] | chunk["imports"]
+    if not required <= defined:
+        missing = ", ".join(sorted(required - defined))
+        return [], chunk["code"], f"review dropped {missing}, kept the original code."
+    if not chunk["defines"]:
+        # Script code defines nothing to check, so make sure it still does the same things
+        used = {
+            child.id for node in body for child in ast.walk(node)
+            if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load)
+        }
+        if len(body) < chunk["statements"] or not chunk["uses"] <= used:
+            return [], chunk["code"], "review dropped top-level statements, kept the original code."
+    return imports, code, strip_code_blocks(response)
+
+
+def should_chunk(stage_input, max_lines=CHUNK_MAX_LINES):
+    code = extract_code(stage_input)
+    if code is None or len(code.splitlines()) <= max_lines:
+        return False
+    try:
+        ast.parse(code)
+    except SyntaxError:
+        return False
+    return True
+
+
+def run_chunked_stage(agent, stage_input, max_lines=CHUNK_MAX_LINES, workers=CHUNK_WORKERS):
+    # Review the chunks concurrently and reassemble them in their original order
+    preamble, chunks = split_code(extract_code(stage_input), max_lines=max_lines)
+    total = len(chunks)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, total))) as executor:
+        # Copy the context per call so token usage stays attributed to this stage
+        futures = [
+            executor.submit(contextvars.copy_context().run, review_chunk, agent, preamble, chunk, part, total)
+            for part, chunk in enumerate(chunks, start=1)
+        ]
+        results = [future.result() for future in futures]
+
+    known = {ast.unparse(node) for node in ast.parse(preamble).body} if preamble else set()
+    extra_imports = []
+    for imports, _, _ in results:
+        for statement in imports:
+            if statement not in known:
+                known.add(statement)
+                extra_imports.append(statement)
+    header = "\n".join(part for part in (preamble, "\n".join(extra_imports)) if part)
+    body = "\n\n\n".join(code for _, code, _ in results)
+    merged = f"{header}\n\n\n{body}" if header else body
+
+    notes = "\n\n".join(f"**Part {part} of {total}:** {note}" for part, (_, _, note) in enumerate(results, start=1) if note)
+    # Only the program is reviewed in chunks; other blocks (tests, config files) are passed on unchanged
+    return render_stage_output(notes, merged, other_blocks(stage_input))
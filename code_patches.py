@@ -0,0 +1,230 @@
+import ast
+import os
+import re
+
+# "full": every stage rewrites the whole program, "patch": reviewer stages answer with unified diffs
+HANDOFF_MODE = os.getenv("CHAIN_REACT_HANDOFF_MODE", "full")
+
+FENCE_RE = re.compile(r"```([\w+-]*)[ \t]*\n(.*?)```", re.DOTALL)
+DIFF_LANGUAGES = ("diff", "patch", "udiff")
+HUNK_RE = re.compile(r"^@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@")
+INDEX_RE = re.compile(r"^index [0-9a-f]+\.\.[0-9a-f]+")
+
+PATCH_INSTRUCTIONS = """
+Review the Python program below according to your role. Do NOT repeat the full program.
+Explain your findings briefly, then express every code change as a unified diff against the program exactly as
+given, inside a single ```diff fenced block. Copy at least three unchanged context lines around each change verbatim.
+If the program needs no code changes, return an empty ```diff block.
+"""
+
+
+class PatchError(Exception):
+    pass
+
+
+def _fenced_blocks(text, languages):
+    return [body for language, body in FENCE_RE.findall(text or "") if language.lower() in languages]
+
+
+def _program_block(text):
+    # Match of the largest ```python block, falling back to untagged fences
+    matches = list(FENCE_RE.finditer(text or ""))
+    blocks = [m for m in matches if m.group(1).lower() in ("python", "py")] or [m for m in matches if not m.group(1)]
+    return max(blocks, key=lambda match: len(match.group(2))) if blocks else None
+
+
+def extract_code(text):
+    # None when the text carries no code
+    match = _program_block(text)
+    return match.group(2) if match is not None else None
+
+
+def extract_diff(text):
+    blocks = _fenced_blocks(text, DIFF_LANGUAGES)
+    return "\n".join(blocks) if blocks else None
+
+
+def other_blocks(text, skip_program=True):
+    # Fenced blocks besides the program and any diffs (tests, config files...), verbatim
+    program = _program_block(text) if skip_program else None
+    return [
+        match.group(0) for match in FENCE_RE.finditer(text or "")
+        if (program is None or match.span() != program.span()) and match.group(1).lower() not in DIFF_LANGUAGES
+    ]
+
+
+def strip_code_blocks(text):
+    return FENCE_RE.sub("", text or "").strip()
+
+
+def parses(code):
+    try:
+        ast.parse(code)
+        return True
+    except SyntaxError:
+        return False
+
+
+def top_level_names(code):
+    names = set()
+    for node in ast.parse(code).body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.Assign):
+            names.update(target.id for target in node.targets if isinstance(target, ast.Name))
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            names.add(node.target.id)
+    return names
+
+
+def is_full_regeneration(code, candidate):
+    # A code block in a no-diff reply only replaces the program if it plausibly is the whole program,
+    # not a usage snippet: it must keep every top-level name, or at least half the size when there are none
+    if not parses(code):
+        return len(candidate) >= len(code) / 2
+    if not parses(candidate):
+        return False
+    names = top_level_names(code)
+    if names:
+        return names <= top_level_names(candidate)
+    return len(candidate) >= len(code) / 2
+
+
+def _parse_hunks(diff_text):
+    hunks = []
+    current = None
+    lines = diff_text.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith("--- ") and i + 1 < len(lines) and lines[i + 1].startswith("+++ "):
+            # File header
+            i += 2
+            continue
+        match = HUNK_RE.match(line)
+        if match or line.startswith("@@"):
+            current = {"start": int(match.group(1)) if match else None, "old": [], "new": []}
+            hunks.append(current)
+        elif line.startswith(("diff --git", "\\")) or INDEX_RE.match(line):
+            pass
+        else:
+            if current is None:
+                # Models sometimes leave out the @@ header entirely
+                current = {"start": None, "old": [], "new": []}
+                hunks.append(current)
+            if line.startswith("+"):
+                current["new"].append(line[1:])
+            elif line.startswith("-"):
+                current["old"].append(line[1:])
+            else:
+                # Context line; blank context lines often lose their leading space
+                text = line[1:] if line.startswith(" ") else line
+                current["old"].append(text)
+                current["new"].append(text)
+        i += 1
+    return [hunk for hunk in hunks if hunk["old"] != hunk["new"]]
+
+
+def _find_block(lines, block, cursor, hint):
+    size = len(block)
+    wanted = [line.rstrip() for line in block]
+    candidates = [
+        i for i in range(len(lines) - size + 1)
+        if [line.rstrip() for line in lines[i:i + size]] == wanted
+    ]
+    if not candidates:
+        return None
+    # Prefer matches after the previous hunk, then the one closest to the line number in the header
+    forward = [i for i in candidates if i >= cursor] or candidates
+    if hint is None:
+        return forward[0]
+    return min(forward, key=lambda i: abs(i - hint))
+
+
+def apply_unified_diff(source, diff_text):
+    # Hunks are located by their content rather than trusting the model's line numbers
+    lines = source.splitlines()
+    cursor = 0
+    offset = 0
+    for hunk in _parse_hunks(diff_text):
+        old, new = hunk["old"], hunk["new"]
+        if old:
+            hint = None if hunk["start"] is None else hunk["start"] - 1 + offset
+            position = _find_block(lines, old, cursor, hint)
+            if position is None:
+                raise PatchError(f"hunk does not apply: {old[0].strip()!r}")
+        elif hunk["start"] is not None:
+            position = min(max(hunk["start"] + offset, 0), len(lines))
+        else:
+            position = len(lines)
+        lines[position:position + len(old)] = new
+        cursor = position + len(new)
+        offset += len(new) - len(old)
+    return "\n".join(lines) + ("\n" if source.endswith("\n") or not source else "")
+
+
+def apply_response(code, response):
+    # Turn a reviewer's answer into the next version of the program
+    if not response or response.startswith("Error:"):
+        raise PatchError(response or "empty response")
+    diff = extract_diff(response)
+    if diff is not None:
+        patched = apply_unified_diff(code, diff)
+    else:
+        # No diff: either the model regenerated the program anyway or it had nothing to change
+        regenerated = extract_code(response)
+        if regenerated is not None and not is_full_regeneration(code, regenerated):
+            raise PatchError("reply has no diff and its code is not a full program")
+        patched = regenerated or code
+    if parses(code) and not parses(patched):
+        raise PatchError("patched program no longer parses")
+    return patched
+
+
+def build_patch_task(previous_output, code):
+    notes = strip_code_blocks(previous_output)
+    extras = other_blocks(previous_output)
+    task = PATCH_INSTRUCTIONS.strip()
+    if notes:
+        task += f"\n\nNotes from the previous stage:\n{notes}"
+    if extras:
+        task += "\n\nOther files from the previous stage, for reference only:\n" + "\n\n".join(extras)
+    return f"{task}\n\nProgram:\n```python\n{code.rstrip()}\n```"
+
+
+def render_stage_output(notes, code, extras=()):
+    # The program block followed by any other blocks (tests, config files) carried over unchanged
+    notes = (notes or "").strip()
+    blocks = [f"```python\n{code.rstrip()}\n```", *extras]
+    return "\n\n".join([notes, *blocks] if notes else blocks)
+
+
+def carried_blocks(previous_output, response, response_has_program):
+    # Blocks to keep besides the program: the previous stage's, plus any new ones in the response
+    extras = other_blocks(previous_output)
+    added = other_blocks(response, skip_program=response_has_program)
+    return extras + [block for block in added if block not in extras]
+
+
+def run_patch_stage(agent, previous_output):
+    # Returns (stage_output, handoff) where handoff is "patch" or "full", or (None, "fallback") when the
+    # patch did not apply and the caller has to decide whether to regenerate in full
+    code = extract_code(previous_output)
+    if code is None:
+        return agent(previous_output), "full"
+    response = agent(build_patch_task(previous_output, code))
+    if response and response.startswith("Error:"):
+        # A failed API call is not a bad patch; hand the error back instead of regenerating
+        return response, "patch"
+    try:
+        patched = apply_response(code, response)
+    except PatchError:
+        return None, "fallback"
+    # Only the program is replaced; a reply without a diff carries the regenerated program itself
+    extras = carried_blocks(previous_output, response, response_has_program=extract_diff(response) is None)
+    return render_stage_output(strip_code_blocks(response), patched, extras), "patch"
+
+
+def regenerate_in_full(agent, previous_output):
+    # Call the model directly so the failed patch attempt isn't part of the agent's conversation memory
+    return agent.llm(f"{agent.system_prompt.strip()}\n\n{previous_output}")
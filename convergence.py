@@ -0,0 +1,44 @@
+import ast
+import os
+import re
+
+from code_patches import extract_code
+
+
+def normalise_code(code, compare="ast"):
+    # AST comparison ignores comments and formatting; "text" only collapses whitespace
+    if compare == "ast":
+        try:
+            return ast.dump(ast.parse(code))
+        except SyntaxError:
+            pass
+    lines = (re.sub(r"\s+", " ", line).strip() for line in code.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+class ConvergencePolicy:
+    def __init__(self, skip_when_unchanged=(), stop_when_unchanged=False, compare="ast"):
+        # skip_when_unchanged: stages skipped when the stage before them made no code changes
+        # stop_when_unchanged: end the chain as soon as a stage returns the code it was given
+        self.skip_when_unchanged = set(skip_when_unchanged)
+        self.stop_when_unchanged = stop_when_unchanged
+        self.compare = compare
+
+    @classmethod
+    def from_env(cls):
+        skip = os.getenv("CHAIN_REACT_SKIP_WHEN_UNCHANGED", "")
+        return cls(
+            skip_when_unchanged=[name.strip() for name in skip.split(",") if name.strip()],
+            stop_when_unchanged=os.getenv("CHAIN_REACT_STOP_WHEN_UNCHANGED", "0").lower() in ("1", "true", "yes"),
+            compare=os.getenv("CHAIN_REACT_CONVERGENCE_COMPARE", "ast"),
+        )
+
+    def unchanged(self, stage_input, stage_output):
+        # Only outputs that both carry code can be compared
+        before, after = extract_code(stage_input), extract_code(stage_output)
+        if before is None or after is None:
+            return False
+        return normalise_code(before, self.compare) == normalise_code(after, self.compare)
+
+    def should_skip(self, stage_name, previous_unchanged):
+        return previous_unchanged and stage_name in self.skip_when_unchanged
@@ -1,11 +1,22 @@
 import os
 import re
+import sys
+import uuid
 from dotenv import load_dotenv
 from swarms import Agent, AgentRearrange
 from groq import Groq
 
-# Load environment variables
+# Load environment variables (before the helper modules below read their CHAIN_REACT_* settings)
 load_dotenv()
+
+# Shared helpers live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from code_patches import HANDOFF_MODE
+from chunked_review import REVIEW_MODE
+from speculative import SPECULATIVE
+from chain_runner import run_chain
+from chain_backend import GroqModel, usage_store, token_budget, convergence_policy, job_queue
+
 api_key = os.getenv("GROQ_API_KEY")
 if not api_key:
     raise ValueError("GROQ_API_KEY environment variable is not set.")
@@ -14,27 +25,8 @@ if not api_key:
 client = Groq(api_key=api_key)
 print("Environment set up and Groq client initialized successfully!")
 
-# Define the Groq-based model
-class GroqModel:
-    def __init__(self, client):
-        self.client = client
-
-    def __call__(self, prompt):
-        try:
-            response = self.client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": "You are a Python code expert."},
-                    {"role": "user", "content": prompt}
-                ],
-                model="llama-3.3-70b-versatile",
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            print(f"Error during API call: {e}")
-            return f"Error: {e}"
-
 # Initialize the model
-model = GroqModel(client=client)
+model = GroqModel(client=client, usage_store=usage_store)
 
 # Define agents
 first_draft_agent = Agent(
@@ -110,20 +102,46 @@ def save_to_py_file(filename, code):
         file.write(code)
     print(f"Finalized code saved to {filename}")
 
-# Main processing function
-def process_code(input_prompt, output_filename):
-    try:
-        # Step through the agents
-        draft_code = first_draft_agent(input_prompt)
-        refined_code = compatibility_agent(draft_code)
-        final_code = qa_agent(refined_code)
-
-        # Save the final output to a .py file
-        save_to_py_file(output_filename, final_code)
-
-        print("Code refinement process completed successfully!")
-    except Exception as e:
-        print(f"Error during code processing: {e}")
+# Worker entry point for queued refinement jobs (see job_worker.py); errors propagate so the job is retried
+def run_code_job(payload, attempt=1, cancel=None):
+    # Every attempt gets its own run id so retries don't inherit the failed attempt's spend
+    session_id, run_id = payload["session_id"], f"{payload['run_id']}-{attempt}"
+
+    # Step through the agents, with budget and convergence checks between stages
+    final_code, report = run_chain(
+        agents, payload["input_prompt"], usage_store, token_budget, session_id, run_id,
+        handoff_mode=payload.get("handoff_mode", HANDOFF_MODE), convergence=convergence_policy,
+        review_mode=payload.get("review_mode", REVIEW_MODE), speculative=payload.get("speculative", SPECULATIVE),
+        cancel=cancel,
+    )
+    for entry in report:
+        print(f"{entry['stage']}: {entry['status']}" + (f" ({entry['reason']})" if entry.get("reason") else ""))
+
+    # Save the final output to a .py file
+    save_to_py_file(payload["output_filename"], final_code)
+
+    usage = usage_store.totals(run_id=run_id)
+    print(f"Token usage: {usage['prompt_tokens']} prompt + {usage['completion_tokens']} completion")
+    return {"output_filename": payload["output_filename"], "run_id": run_id, "usage": usage, "stages": report}
+
+# Main processing function: queues the chain for a worker and returns the job id
+def process_code(
+    input_prompt, output_filename, session_id="cli",
+    handoff_mode=HANDOFF_MODE, review_mode=REVIEW_MODE, speculative=SPECULATIVE,
+):
+    return job_queue.enqueue(
+        "dev.backend_groq:run_code_job",
+        {
+            "input_prompt": input_prompt,
+            # Workers may run from another directory
+            "output_filename": os.path.abspath(output_filename),
+            "session_id": session_id,
+            "run_id": uuid.uuid4().hex,
+            "handoff_mode": handoff_mode,
+            "review_mode": review_mode,
+            "speculative": speculative,
+        },
+    )
 
 if __name__ == "__main__":
     # Example input prompt
@@ -133,4 +151,11 @@ if __name__ == "__main__":
     """
 
     output_file = "refined_program.py"
-    process_code(input_prompt, output_file)
+    job_id = process_code(input_prompt, output_file)
+    print(f"Queued job {job_id}; start workers with `python job_worker.py` if none are running.")
+
+    job = job_queue.wait(job_id)
+    if job["status"] == "done":
+        print("Code refinement process completed successfully!")
+    else:
+        print(f"Error during code processing: {job['error']}")
@@ -0,0 +1,168 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+# Local SQLite file shared by the web process and the workers
+JOB_DB_PATH = os.getenv("CHAIN_REACT_JOB_DB", "jobs.db")
+
+# A worker must heartbeat within this many seconds or its job is handed to another worker
+LEASE_SECONDS = int(os.getenv("CHAIN_REACT_JOB_LEASE_SECONDS", "120"))
+MAX_ATTEMPTS = int(os.getenv("CHAIN_REACT_JOB_MAX_ATTEMPTS", "3"))
+RETRY_BACKOFF_SECONDS = 5
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue:
+    def __init__(self, path=JOB_DB_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    handler TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    available_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, available_at)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, handler, payload, max_attempts=MAX_ATTEMPTS):
+        # handler is a "module:function" path the worker imports and calls with the payload
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, handler, payload, status, max_attempts, available_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, handler, json.dumps(payload), QUEUED, max_attempts, now, now, now),
+            )
+        return job_id
+
+    def claim(self, worker_id, lease_seconds=LEASE_SECONDS):
+        # Atomically take the oldest runnable job, including ones whose worker died mid-lease
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, lease_owner = NULL, updated_at = ? "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= max_attempts",
+                (FAILED, "lease expired on the final attempt", now, RUNNING, now),
+            )
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE (status = ? AND available_at <= ?) OR (status = ? AND lease_expires < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (QUEUED, now, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_expires = ?, updated_at = ? "
+                "WHERE id = ?",
+                (RUNNING, worker_id, now + lease_seconds, now, row["id"]),
+            )
+            job = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+        return self._to_dict(job)
+
+    def heartbeat(self, job_id, worker_id, lease_seconds=LEASE_SECONDS):
+        # Returns False once the lease has been lost to another worker
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                (now + lease_seconds, now, job_id, RUNNING, worker_id),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id, result):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = NULL, lease_owner = NULL, lease_expires = NULL, "
+                "updated_at = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                (DONE, json.dumps(result), time.time(), job_id, RUNNING, worker_id),
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker_id, error, retry=True):
+        # Requeue with a growing delay until the job runs out of attempts (or straight to failed if retry is False)
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND status = ? AND lease_owner = ?",
+                (job_id, RUNNING, worker_id),
+            ).fetchone()
+            if row is None:
+                return False
+            if retry and row["attempts"] < row["max_attempts"]:
+                status, available_at = QUEUED, now + RETRY_BACKOFF_SECONDS * row["attempts"]
+            else:
+                status, available_at = FAILED, now
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, lease_owner = NULL, lease_expires = NULL, available_at = ?, "
+                "updated_at = ? WHERE id = ?",
+                (status, error, available_at, now, job_id),
+            )
+        return True
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def watch(self, job_id, poll_interval=1.0, timeout=None):
+        # Yields the job whenever its status or attempt count changes, ending once it is done or failed
+        deadline = None if timeout is None else time.time() + timeout
+        last_seen = None
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                raise KeyError(f"Unknown job: {job_id}")
+            if (job["status"], job["attempts"]) != last_seen:
+                last_seen = (job["status"], job["attempts"])
+                yield job
+            if job["status"] in (DONE, FAILED):
+                return
+            if deadline is not None and time.time() >= deadline:
+                return
+            time.sleep(poll_interval)
+
+    def wait(self, job_id, poll_interval=1.0, timeout=None):
+        job = None
+        for job in self.watch(job_id, poll_interval=poll_interval, timeout=timeout):
+            pass
+        return job
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
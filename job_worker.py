@@ -0,0 +1,100 @@
+import argparse
+import importlib
+import os
+import socket
+import threading
+import time
+import traceback
+
+from dotenv import load_dotenv
+from pathos.multiprocessing import ProcessPool
+
+# Load environment variables (before the helper modules below read their CHAIN_REACT_* settings)
+load_dotenv()
+
+from job_queue import JobQueue, JOB_DB_PATH, LEASE_SECONDS
+from token_usage import BudgetExceeded
+
+
+def resolve_handler(spec):
+    # "chain_react:run_prompt_job" -> chain_react.run_prompt_job
+    module_name, _, function_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def _keep_lease(queue, job_id, worker_id, lease_seconds, stop, lost):
+    while not stop.wait(lease_seconds / 3):
+        if not queue.heartbeat(job_id, worker_id, lease_seconds):
+            # Another worker may already be running the job; tell the handler to give up
+            print(f"[{worker_id}] Lost the lease on job {job_id}")
+            lost.set()
+            return
+
+
+def worker_loop(worker_index, db_path=JOB_DB_PATH, poll_interval=1.0, lease_seconds=LEASE_SECONDS, max_jobs=None):
+    queue = JobQueue(db_path)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{worker_index}"
+    print(f"[{worker_id}] Waiting for jobs in {db_path}")
+    processed = 0
+    while max_jobs is None or processed < max_jobs:
+        job = queue.claim(worker_id, lease_seconds)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        # Heartbeat in the background so long chains keep their lease
+        stop = threading.Event()
+        lost = threading.Event()
+        heartbeat = threading.Thread(
+            target=_keep_lease, args=(queue, job["id"], worker_id, lease_seconds, stop, lost), daemon=True
+        )
+        heartbeat.start()
+        try:
+            # Handlers get the attempt number so each retry is accounted for separately, and stop between
+            # stages once the lease is lost
+            result = resolve_handler(job["handler"])(job["payload"], attempt=job["attempts"], cancel=lost)
+            if queue.complete(job["id"], worker_id, result):
+                print(f"[{worker_id}] Job {job['id']} done")
+            else:
+                print(f"[{worker_id}] Job {job['id']} finished after its lease was lost, result discarded")
+        except Exception as e:
+            if lost.is_set():
+                # The job belongs to another worker now, leave its state alone
+                print(f"[{worker_id}] Abandoned job {job['id']}: {e}")
+            elif isinstance(e, BudgetExceeded):
+                # Retrying cannot help until the budget resets
+                queue.fail(job["id"], worker_id, f"{type(e).__name__}: {e}", retry=False)
+                print(f"[{worker_id}] Job {job['id']} failed: {e}")
+            else:
+                traceback.print_exc()
+                queue.fail(job["id"], worker_id, f"{type(e).__name__}: {e}")
+                print(f"[{worker_id}] Job {job['id']} failed (attempt {job['attempts']} of {job['max_attempts']})")
+        finally:
+            stop.set()
+            heartbeat.join()
+        processed += 1
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run chain-react job workers")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("CHAIN_REACT_WORKERS", "2")))
+    parser.add_argument("--db", default=JOB_DB_PATH)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    args = parser.parse_args()
+
+    pool = ProcessPool(nodes=args.workers)
+    try:
+        pool.map(
+            lambda index: worker_loop(index, db_path=args.db, poll_interval=args.poll_interval),
+            range(args.workers),
+        )
+    except KeyboardInterrupt:
+        print("Stopping workers...")
+        pool.terminate()
+    finally:
+        pool.clear()
+
+
+if __name__ == "__main__":
+    main()
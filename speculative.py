@@ -0,0 +1,160 @@
+import contextvars
+import os
+import threading
+
+from code_patches import FENCE_RE, extract_code
+from convergence import ConvergencePolicy
+from token_usage import TokenBudget, BudgetExceeded, usage_context, estimate_tokens, estimate_call
+
+# Start each downstream stage as soon as the upstream stage's code block has closed in the stream
+SPECULATIVE = os.getenv("CHAIN_REACT_SPECULATIVE", "0").lower() in ("1", "true", "yes")
+
+
+def code_block_end(text):
+    # Offset just past the first closed ```python (or untagged) block, or None
+    for match in FENCE_RE.finditer(text):
+        if match.group(1).lower() in ("python", "py", ""):
+            return match.end()
+    return None
+
+
+def same_code(seen, final):
+    return (extract_code(seen) or seen).strip() == (extract_code(final) or final).strip()
+
+
+class StageRun:
+    def __init__(self, index, agent, stage_input, model, context):
+        self.index = index
+        self.agent = agent
+        self.input = stage_input
+        # Call the model directly: speculative and restarted calls must not share the agent's conversation memory
+        self.prompt = f"{agent.system_prompt.strip()}\n\n{stage_input}"
+        self.model = model
+        self.text = ""
+        self.prefix = None
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        # Run in a copy of the caller's context so usage is attributed to this stage
+        self._thread = threading.Thread(target=context.run, args=(self._run,), daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            for piece in self.agent.llm.stream(self.prompt, cancel=self.cancelled):
+                self.text += piece
+                if self.prefix is None and "`" in piece:
+                    end = code_block_end(self.text)
+                    if end is not None:
+                        self.prefix = self.text[:end]
+                        self.ready.set()
+        except Exception as e:
+            self.text = f"Error: {e}"
+        finally:
+            self.ready.set()
+            self.done.set()
+
+    def snapshot(self):
+        # What a downstream stage started now would see
+        return self.prefix if self.prefix is not None else self.text
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+def run_speculative_chain(
+    agents, prompt, usage_store, token_budget, session_id, run_id, convergence=None, check_cancelled=None,
+    check_output=None,
+):
+    # Same contract as chain_runner.run_chain, overlapping each stage with the tail of the one before it
+    convergence = convergence or ConvergencePolicy()
+    report = []
+
+    def record(agent, status, **details):
+        entry = {"stage": agent.agent_name, "status": status, **details}
+        report.append(entry)
+        usage_store.record_stage(session_id, run_id, agent.agent_name, status, details.get("reason"))
+
+    def budget_status(agent, stage_input, pending=0):
+        # pending: estimated spend of an upstream stage that is still streaming and not recorded yet
+        upcoming = estimate_call([agent.system_prompt, stage_input], stage_input) + pending
+        return token_budget.status(usage_store, session_id=session_id, run_id=run_id, upcoming=upcoming)
+
+    def launch(index, stage_input, pending=0):
+        agent = agents[index]
+        status = budget_status(agent, stage_input, pending)
+        if status == TokenBudget.EXHAUSTED:
+            if index == 0:
+                raise BudgetExceeded("token budget exhausted before the first draft could be generated")
+            return None
+        model_override = token_budget.fallback_model if status == TokenBudget.DOWNGRADE else None
+        with usage_context(session_id=session_id, run_id=run_id, stage=agent.agent_name, model=model_override):
+            context = contextvars.copy_context()
+        return StageRun(index, agent, stage_input, model_override, context).start()
+
+    def skip_rest(start, reason):
+        for remaining in agents[start:]:
+            record(remaining, "skipped", reason=reason)
+
+    run = launch(0, prompt)
+    restarted = False
+    output = prompt
+    while True:
+        next_index = run.index + 1
+        following = None
+        if next_index < len(agents):
+            # Speculate on the upstream prefix as soon as its code block has closed
+            run.ready.wait()
+            following = launch(next_index, run.snapshot(), pending=estimate_tokens(run.prompt) + estimate_tokens(run.text))
+        run.done.wait()
+        output = run.text
+        try:
+            if check_cancelled is not None:
+                check_cancelled()
+            if check_output is not None:
+                check_output(run.agent, output)
+        except Exception:
+            if following is not None:
+                following.cancel()
+            raise
+
+        unchanged = convergence.unchanged(run.input, output)
+        record(run.agent, "executed", model=run.model, handoff="speculative", restarted=restarted, unchanged=unchanged)
+        if next_index >= len(agents):
+            break
+        if unchanged and convergence.stop_when_unchanged:
+            if following is not None:
+                following.cancel()
+            skip_rest(next_index, f"{run.agent.agent_name} returned the code unchanged")
+            break
+
+        while next_index < len(agents) and convergence.should_skip(agents[next_index].agent_name, unchanged):
+            if following is not None:
+                following.cancel()
+                following = None
+            record(agents[next_index], "skipped", reason="previous stage made no code changes")
+            next_index += 1
+        if next_index >= len(agents):
+            break
+
+        # Keep the speculative call only if it saw the code the upstream stage finally produced
+        restarted = following is not None and not same_code(following.input, output)
+        if following is not None and not restarted:
+            # The speculative launch only estimated the upstream spend; recheck now that it is recorded
+            status = budget_status(following.agent, following.input)
+            if status == TokenBudget.EXHAUSTED or (status == TokenBudget.DOWNGRADE and following.model is None):
+                following.cancel()
+                following = None
+        if following is None or restarted:
+            if following is not None:
+                following.cancel()
+            following = launch(next_index, output)
+            if following is None:
+                skip_rest(next_index, "token budget exhausted")
+                break
+        run = following
+
+    return output, report
@@ -0,0 +1,225 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+
+# Local SQLite file that holds one row per LLM call
+USAGE_DB_PATH = os.getenv("CHAIN_REACT_USAGE_DB", "token_usage.db")
+
+# Smaller model used once a budget passes its downgrade threshold
+FALLBACK_MODEL = os.getenv("CHAIN_REACT_FALLBACK_MODEL", "llama-3.1-8b-instant")
+
+# Added to every pre-call estimate for what it cannot see: chat formatting and the agents' conversation memory
+ESTIMATE_MARGIN_TOKENS = int(os.getenv("CHAIN_REACT_ESTIMATE_MARGIN_TOKENS", "500"))
+
+# Session/run/stage of the LLM call currently in flight, plus an optional model override
+_call_context = ContextVar("call_context", default={})
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+@contextmanager
+def usage_context(**fields):
+    # Tag every LLM call made inside the block with the given fields (session_id, run_id, stage, model)
+    token = _call_context.set({**_call_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _call_context.reset(token)
+
+
+def current_context():
+    return dict(_call_context.get())
+
+
+def estimate_tokens(text):
+    # Rough heuristic (~4 characters per token), good enough to decide whether a stage still fits
+    return len(text or "") // 4 + 1
+
+
+def estimate_call(prompts, reply_like):
+    # Every prompt sent, a reply about as long as `reply_like`, and the fixed margin
+    return sum(estimate_tokens(prompt) for prompt in prompts) + estimate_tokens(reply_like) + ESTIMATE_MARGIN_TOKENS
+
+
+class UsageStore:
+    COLUMNS = ("session_id", "run_id", "stage", "model", "day")
+
+    def __init__(self, path=USAGE_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS token_usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at REAL NOT NULL,
+                    day TEXT NOT NULL,
+                    session_id TEXT,
+                    run_id TEXT,
+                    stage TEXT,
+                    model TEXT,
+                    prompt_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS stage_runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at REAL NOT NULL,
+                    session_id TEXT,
+                    run_id TEXT,
+                    stage TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    reason TEXT
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_stage_runs_run ON stage_runs (run_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_day ON token_usage (day)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_run ON token_usage (run_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_token_usage_session ON token_usage (session_id)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def record(self, model, prompt_tokens, completion_tokens, session_id=None, run_id=None, stage=None):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO token_usage (created_at, day, session_id, run_id, stage, model, prompt_tokens, completion_tokens) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    time.time(),
+                    date.today().isoformat(),
+                    session_id,
+                    run_id,
+                    stage,
+                    model,
+                    int(prompt_tokens or 0),
+                    int(completion_tokens or 0),
+                ),
+            )
+
+    def record_stage(self, session_id, run_id, stage, status, reason=None):
+        # One row per stage and run: "executed" or "skipped" (with the reason)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO stage_runs (created_at, session_id, run_id, stage, status, reason) VALUES (?, ?, ?, ?, ?, ?)",
+                (time.time(), session_id, run_id, stage, status, reason),
+            )
+
+    def stage_events(self, run_id):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT stage, status, reason FROM stage_runs WHERE run_id = ? ORDER BY id", (run_id,)
+            ).fetchall()
+        return [{"stage": stage, "status": status, "reason": reason} for stage, status, reason in rows]
+
+    def record_response(self, model, usage):
+        # Record the `usage` block of a chat completion against the current call context
+        if usage is None:
+            return
+        context = current_context()
+        self.record(
+            model=model,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0),
+            completion_tokens=getattr(usage, "completion_tokens", 0),
+            session_id=context.get("session_id"),
+            run_id=context.get("run_id"),
+            stage=context.get("stage"),
+        )
+
+    def record_estimate(self, model, prompt, completion):
+        # Cancelled streams never receive a usage block, so charge an estimate instead
+        context = current_context()
+        self.record(
+            model=model,
+            prompt_tokens=estimate_tokens(prompt),
+            completion_tokens=estimate_tokens(completion),
+            session_id=context.get("session_id"),
+            run_id=context.get("run_id"),
+            stage=context.get("stage"),
+        )
+
+    def totals(self, **filters):
+        unknown = set(filters) - set(self.COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown usage filter(s): {', '.join(sorted(unknown))}")
+        where = " AND ".join(f"{column} = ?" for column in filters) or "1 = 1"
+        with self._connect() as conn:
+            prompt_tokens, completion_tokens = conn.execute(
+                f"SELECT COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0) FROM token_usage WHERE {where}",
+                tuple(filters.values()),
+            ).fetchone()
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def stage_breakdown(self, run_id):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT stage, model, SUM(prompt_tokens), SUM(completion_tokens) FROM token_usage "
+                "WHERE run_id = ? GROUP BY stage, model ORDER BY MIN(id)",
+                (run_id,),
+            ).fetchall()
+        return [
+            {"stage": stage, "model": model, "prompt_tokens": prompt, "completion_tokens": completion}
+            for stage, model, prompt, completion in rows
+        ]
+
+
+class TokenBudget:
+    OK = "ok"
+    DOWNGRADE = "downgrade"
+    EXHAUSTED = "exhausted"
+
+    def __init__(self, per_run=0, per_session=0, per_day=0, downgrade_at=0.8, fallback_model=FALLBACK_MODEL):
+        # A limit of 0 disables that scope
+        self.per_run = per_run
+        self.per_session = per_session
+        self.per_day = per_day
+        self.downgrade_at = downgrade_at
+        self.fallback_model = fallback_model
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            per_run=int(os.getenv("CHAIN_REACT_RUN_TOKEN_BUDGET", "0")),
+            per_session=int(os.getenv("CHAIN_REACT_SESSION_TOKEN_BUDGET", "0")),
+            per_day=int(os.getenv("CHAIN_REACT_DAILY_TOKEN_BUDGET", "0")),
+            downgrade_at=float(os.getenv("CHAIN_REACT_BUDGET_DOWNGRADE_AT", "0.8")),
+        )
+
+    def status(self, store, session_id=None, run_id=None, upcoming=0):
+        # Compare spend so far plus the estimated cost of the next call against every configured limit
+        scopes = [
+            (self.per_run, {"run_id": run_id}),
+            (self.per_session, {"session_id": session_id}),
+            (self.per_day, {"day": date.today().isoformat()}),
+        ]
+        worst = 0.0
+        for limit, filters in scopes:
+            if not limit or None in filters.values():
+                continue
+            used = store.totals(**filters)["total_tokens"]
+            if used + upcoming > limit:
+                return self.EXHAUSTED
+            worst = max(worst, (used + upcoming) / limit)
+        if worst >= self.downgrade_at:
+            return self.DOWNGRADE
+        return self.OK